@@ -0,0 +1,290 @@
+#   LightControl. Traffic light control using object detection.
+#   Copyright (C) 2016  Jose Lamego <joselamego@outlook.com>
+#   All rights reserved.
+#   Redistribution and use in source and binary forms, with or without
+#   modification, are permitted provided that the following conditions are met:
+#
+#   1. Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+#
+#   2. Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+#
+#   3. Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from this
+#   software without specific prior written permission.
+#
+#   THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+#   AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+#   IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+#   ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+#   LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+#   CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+#   SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+#   INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+#   CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+#   ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+#   POSSIBILITY OF SUCH DAMAGE.
+#
+
+
+import argparse
+import json
+import logging
+import math
+import sys
+import threading
+import time
+from collections import deque
+
+# Number of latency samples kept per hop
+max_samples = 10000
+# Percentiles included in the report
+report_percentiles = (50, 90, 95, 99)
+# Millisecond stats reported for each hop
+report_stats = ['min', 'max'] + ['p' + str(p) for p in report_percentiles]
+
+
+class frame_tag(object):
+    """frame_tag class
+    Identifies one frame and carries the time of its last recorded
+    hop through detection, decision and GPIO actuation.
+    Frames are stamped when their read starts: frames buffered by the
+    camera driver are older than that, which the latencies leave out.
+    """
+    def __init__(self, frame_id, read_start):
+        """ Constructor
+        :type frame_id: int
+        :param frame_id: Sequential frame number
+        :type read_start: float
+        :param read_start: Time the frame read started, in seconds
+        """
+        self.frame_id = frame_id
+        self.read_start = read_start
+        self.last_hop = read_start
+
+
+class latency_tracer(object):
+    """latency_tracer class
+    Hands out frame tags and records the latency of each hop
+    a tag goes through. Hops may be recorded from any thread.
+    """
+    def __init__(self, mode='live'):
+        """ Constructor
+        :type mode: str
+        :param mode: Run mode reported with the results (live or replay)
+        """
+        self.mode = mode
+        self.next_id = 0
+        self.samples = {}
+        self.lock = threading.Lock()
+
+    def tag(self):
+        """Return a new tag stamped with the current time"""
+        with self.lock:
+            self.next_id += 1
+            return frame_tag(self.next_id, time.time())
+
+    def hop(self, tag, name):
+        """Record the time elapsed since the previous hop of tag"""
+        if tag is None:
+            return
+        now = time.time()
+        with self.lock:
+            self._add(name, now - tag.last_hop)
+            tag.last_hop = now
+
+    def finish(self, tag, name='end_to_end'):
+        """Record the time elapsed from read start to the last hop of tag"""
+        if tag is None:
+            return
+        with self.lock:
+            self._add(name, tag.last_hop - tag.read_start)
+        logging.debug(
+            'Frame ' + str(tag.frame_id) + ' actuated ' +
+            str(round((tag.last_hop - tag.read_start) * 1000, 1)) +
+            ' ms after its read started.')
+
+    def _add(self, name, seconds):
+        if name not in self.samples:
+            self.samples[name] = deque(maxlen=max_samples)
+        self.samples[name].append(seconds * 1000)
+
+    def report(self):
+        """Return latency distributions in milliseconds for each hop"""
+        with self.lock:
+            hops = {}
+            for name, values in self.samples.items():
+                hops[name] = distribution(list(values))
+        return {'mode': self.mode, 'hops': hops}
+
+    def save(self, filename):
+        """Write the report to filename as JSON and log a summary"""
+        result = self.report()
+        try:
+            with open(filename, 'w') as report_file:
+                json.dump(result, report_file, indent=2, sort_keys=True)
+            logging.info('Latency report saved to ' + filename + '.')
+        except:
+            logging.error('Cannot save latency report to ' + filename + '.')
+        for name in sorted(result['hops']):
+            stats = result['hops'][name]
+            logging.info(
+                'Latency ' + name + ' (' + self.mode + '): ' +
+                str(stats['count']) + ' samples, p50 ' +
+                str(stats['p50']) + ' ms, p95 ' + str(stats['p95']) +
+                ' ms, max ' + str(stats['max']) + ' ms.')
+        return result
+
+
+class request_tags(object):
+    """request_tags class
+    Hands the tag of the first frame showing motion on the stopped
+    road to the light-change request it causes, and on to the light
+    change serving that request. Only frames seen since the last
+    once-per-second check without motion are kept, so a passing
+    motion blip is never charged to a later request.
+    """
+    def __init__(self, tracer):
+        """ Constructor
+        :type tracer: latency_tracer
+        :param tracer: Tracer recording the decision and dispatch hops
+        """
+        self.tracer = tracer
+        self.pending = None
+        self.change = None
+
+    def motion(self, tag):
+        """Keep tag unless an earlier motion frame is already kept"""
+        if self.pending is None:
+            self.pending = tag
+
+    def no_motion(self):
+        """Drop the kept tag when the check sees no motion"""
+        self.pending = None
+
+    def request(self):
+        """Move the kept tag to the new light-change request"""
+        self.change = self.pending
+        self.pending = None
+        self.tracer.hop(self.change, 'decision')
+
+    def dispatch(self):
+        """Return the tag of the request served by a light change"""
+        self.tracer.hop(self.change, 'dispatch')
+        return self.change
+
+    def clear(self):
+        """Drop both tags once the light change is done"""
+        self.pending = None
+        self.change = None
+
+
+def distribution(values):
+    """
+    Return count, min, max and percentiles of a list of values.
+    Percentiles use the nearest-rank method.
+    """
+    values = sorted(values)
+    n = len(values)
+    stats = {'count': n}
+    if n == 0:
+        return stats
+    stats['min'] = round(values[0], 3)
+    stats['max'] = round(values[-1], 3)
+    for p in report_percentiles:
+        rank = max(-(-p * n // 100), 1)
+        stats['p' + str(p)] = round(values[rank - 1], 3)
+    return stats
+
+
+def check(report, budgets):
+    """
+    Compare a report against per-hop budgets.
+    budgets maps 'hop:stat' to a limit in milliseconds.
+    Return the list of exceeded budgets.
+    """
+    failures = []
+    for key in sorted(budgets):
+        name, stat = key.split(':')
+        stats = report['hops'].get(name, {})
+        if stat not in stats:
+            failures.append(key + ' missing from report')
+        elif stats[stat] > budgets[key]:
+            failures.append(
+                key + ' is ' + str(stats[stat]) + ' ms, budget ' +
+                str(budgets[key]) + ' ms')
+    return failures
+
+
+def valid_report(report):
+    """
+    Return True if report has the layout written by latency_tracer.save().
+    """
+    if not isinstance(report, dict) or 'mode' not in report:
+        return False
+    hops = report.get('hops')
+    if not isinstance(hops, dict):
+        return False
+    for stats in hops.values():
+        if not isinstance(stats, dict):
+            return False
+        for stat in report_stats:
+            if stat in stats and not isinstance(stats[stat], (int, float)):
+                return False
+    return True
+
+
+def budget(text):
+    """
+    Parse a HOP:STAT=MS budget for argparse.
+    Return a ('hop:stat', limit) tuple.
+    """
+    try:
+        key, limit = text.split('=')
+        name, stat = key.split(':')
+        limit = float(limit)
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            "invalid budget '" + text + "', expected HOP:STAT=MS")
+    if math.isnan(limit) or math.isinf(limit) or limit < 0:
+        raise argparse.ArgumentTypeError(
+            "invalid budget '" + text + "', limit must be a finite, "
+            "non-negative number of milliseconds")
+    if not name:
+        raise argparse.ArgumentTypeError(
+            "invalid budget '" + text + "', missing hop name")
+    if stat not in report_stats:
+        raise argparse.ArgumentTypeError(
+            "invalid budget '" + text + "', stat must be one of " +
+            ', '.join(report_stats))
+    return key, limit
+
+
+def main(argv=None):
+    # Fail (exit status 1) when a saved report exceeds its latency budgets
+    ap = argparse.ArgumentParser(
+        description="Check a latency report against per-hop budgets.")
+    ap.add_argument("report", help="latency report saved by scti.py")
+    ap.add_argument("-b", "--budget", action="append", default=[],
+                    type=budget, metavar="HOP:STAT=MS",
+                    help="latency budget, e.g. end_to_end:p95=12500")
+    args = ap.parse_args(argv)
+
+    budgets = dict(args.budget)
+
+    try:
+        with open(args.report) as report_file:
+            report = json.load(report_file)
+    except (IOError, ValueError):
+        ap.error("cannot read latency report '" + args.report + "'")
+    if not valid_report(report):
+        ap.error("invalid latency report '" + args.report + "'")
+    failures = check(report, budgets)
+    for failure in failures:
+        sys.stderr.write(report['mode'] + ': ' + failure + '\n')
+    return 1 if failures else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -47,6 +47,7 @@
 
 # ******* import the necessary packages ***********
 import argparse
+import sys
 from datetime import datetime
 import time
 import cv2
@@ -60,6 +61,7 @@ from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
 from os import listdir
 import sync_time
 import set_server_ip
+import latency_trace
 
 logging.basicConfig(
     filename='log', format='%(asctime)s %(message)s',
@@ -106,6 +108,15 @@ frame_2 = None
 first_frame_1 = None
 first_frame_2 = None
 
+# Latency tracing
+tracer = None
+# change_tags - Hands frame tags on to light-change requests
+change_tags = None
+def_latency_report = 'latency.json'
+
+# Running light-change thread
+thread = None
+
 # **************** light groups *********************
 
 # For "N" number of lights, lights Tuples ('Name',gpio#)
@@ -167,34 +178,59 @@ def turn_off_all_lights():
         logging.error('Cannot turn off all lights.')
 
 
-def cameras_setup():
+class replay_light(object):
+    """replay_light class
+    Stands in for a light GPIO in replay runs,
+    so recorded videos never drive the real pins.
+    """
+    def write(self, value):
+        pass
+
+
+def cameras_setup(replay_files=None):
+    """
+    Open the system cameras, or the given video files for a replay run.
+    """
     global available_cameras
-    try:
-        available_cameras = 0
-        devs = listdir('/dev/')
-        for dev in devs:
-            if 'video' in dev:
-                available_cameras += 1
-        logging.info(
-            'Detected ' + str(available_cameras) +
-            ' available cameras in system.')
-    except:
-        logging.error(
-            'Cannot determine number of available cameras in system.')
+    if replay_files:
+        available_cameras = len(replay_files)
+        logging.info('Replaying ' + ', '.join(replay_files) + '.')
+    else:
+        try:
+            available_cameras = 0
+            devs = listdir('/dev/')
+            for dev in devs:
+                if 'video' in dev:
+                    available_cameras += 1
+            logging.info(
+                'Detected ' + str(available_cameras) +
+                ' available cameras in system.')
+        except:
+            logging.error(
+                'Cannot determine number of available cameras in system.')
 
     global cameras
 
     try:
         for n in range(0, available_cameras):
-            thisCam = cv2.VideoCapture(n)
-            cameras.append(thisCam)
-            time.sleep(0.25)
-            thisCam.set(cv2.cv.CV_CAP_PROP_FRAME_WIDTH, camera_width)
-            thisCam.set(cv2.cv.CV_CAP_PROP_FRAME_HEIGHT, camera_hight)
-            thisCam.set(cv2.cv.CV_CAP_PROP_SATURATION, camera_saturation)
-            logging.info('Configured camera' + str(n+1) + ' size to ' +
-                         str(camera_width) + 'x' + str(camera_hight) +
-                         ' and ' + str(camera_saturation) + ' saturation.')
+            if replay_files:
+                thisCam = cv2.VideoCapture(replay_files[n])
+                cameras.append(thisCam)
+                if not thisCam.isOpened():
+                    logging.error(
+                        'Cannot open replay file ' + replay_files[n] + '.')
+            else:
+                thisCam = cv2.VideoCapture(n)
+                cameras.append(thisCam)
+                time.sleep(0.25)
+                thisCam.set(cv2.cv.CV_CAP_PROP_FRAME_WIDTH, camera_width)
+                thisCam.set(cv2.cv.CV_CAP_PROP_FRAME_HEIGHT, camera_hight)
+                thisCam.set(
+                    cv2.cv.CV_CAP_PROP_SATURATION, camera_saturation)
+                logging.info(
+                    'Configured camera' + str(n+1) + ' size to ' +
+                    str(camera_width) + 'x' + str(camera_hight) +
+                    ' and ' + str(camera_saturation) + ' saturation.')
     except:
         logging.error(
             'Cannot configure camera' + str(n+1) + ' size/saturation.')
@@ -205,17 +241,21 @@ class light_change(object):
     The run()method will be started and
     it will run in the background.
     """
-    def __init__(self, interval=yellow_period_sec):
+    def __init__(self, interval=yellow_period_sec, tag=None):
         """ Constructor
         :type interval: int
         :param interval: Change interval in seconds
+        :type tag: latency_trace.frame_tag
+        :param tag: Tag of the frame that requested the change, if any
         """
         self.interval = interval
+        self.tag = tag
 
         global thread
         thread_light_change = threading.Thread(target=self.run, args=())
         thread_light_change.daemon = False
         thread_light_change.start()
+        thread = thread_light_change
 
     def run(self):
         """Method to change to yellow, then red light"""
@@ -230,6 +270,8 @@ class light_change(object):
             lights[2].write(1)
             thick_1_b = -1
             lights[1].write(0)
+            tracer.hop(self.tag, 'gpio_yellow')
+            tracer.finish(self.tag)
             time.sleep(self.interval)
             thick_1_b = 1
             lights[1].write(1)
@@ -241,12 +283,15 @@ class light_change(object):
             lights[4].write(1)
             thick_2_c = 1
             lights[3].write(1)
+            tracer.hop(self.tag, 'gpio_switch')
             line = 2
         else:
             thick_2_a = 1
             lights[5].write(1)
             thick_2_b = -1
             lights[4].write(0)
+            tracer.hop(self.tag, 'gpio_yellow')
+            tracer.finish(self.tag)
             time.sleep(self.interval)
             thick_2_b = 1
             lights[4].write(1)
@@ -258,9 +303,12 @@ class light_change(object):
             lights[1].write(1)
             thick_1_c = 1
             lights[0].write(1)
+            tracer.hop(self.tag, 'gpio_switch')
             line = 1
 
         moving_line = line
+        # drop the tags before accepting a new change request
+        change_tags.clear()
         change_requested = 0
         lap_to_go = lap_period_sec
 
@@ -326,6 +374,205 @@ class motion_detection():
     """
 
 
+def run_frames(handler=None):
+    """
+    Detect motion and control the lights on every frame until the video
+    ends, streaming the frames to handler when one is given.
+    The latency report is saved when the loop ends for any reason.
+    """
+    try:
+        while True:
+            try:
+                global first_frame_1, first_frame_2
+                global frame_1, frame_2
+                global change_requested
+                # tag the frames with the time their read starts, grab
+                # them and initialize the "Moving object" detection message
+                tag = tracer.tag()
+                (grabbed_1, frame_1) = cameras[0].read()
+                (grabbed_2, frame_2) = cameras[1].read()
+                tracer.hop(tag, 'read')
+                text_1 = no_motion_text
+                text_2 = no_motion_text
+
+                # if one of the frames could not be grabbed,
+                # then we have reached the end of the video
+                if not (grabbed_1 and grabbed_2):
+                    break
+
+                # Draw three circles to simulate a semaphore
+                light_circles()
+
+                # resize the frame, convert it to grayscale, and blur it
+                ksize = make_odd(def_ksize)
+                gray_1 = cv2.cvtColor(frame_1, cv2.COLOR_BGR2GRAY)
+                gray_2 = cv2.cvtColor(frame_2, cv2.COLOR_BGR2GRAY)
+                gray_1 = cv2.GaussianBlur(gray_1, (ksize, ksize), 0)
+                gray_2 = cv2.GaussianBlur(gray_2, (ksize, ksize), 0)
+
+                # if the first frame is None, initialize it
+                if first_frame_1 is None:
+                    first_frame_1 = gray_1
+                    first_frame_2 = gray_2
+                    continue
+
+                # compute the absolute difference between the current
+                # frame and first frame
+                Thresh = def_Thresh
+                frame_delta_1 = cv2.absdiff(first_frame_1, gray_1)
+                frame_delta_2 = cv2.absdiff(first_frame_2, gray_2)
+                thresh1 = cv2.threshold(
+                    frame_delta_1, Thresh, 255, cv2.THRESH_BINARY)[1]
+                thresh2 = cv2.threshold(
+                    frame_delta_2, Thresh, 255, cv2.THRESH_BINARY)[1]
+                # use current frame for next iteration comparisson
+                first_frame_1 = gray_1
+                first_frame_2 = gray_2
+
+                # dilate the thresholded image to fill in holes,
+                # then find contours on thresholded image
+                thresh1 = cv2.dilate(
+                    thresh1, np.ones((dilate_kernel, dilate_kernel)),
+                    iterations=2)
+                thresh2 = cv2.dilate(
+                    thresh2, np.ones((dilate_kernel, dilate_kernel)),
+                    iterations=2)
+                (cnts1, _) = cv2.findContours(
+                    thresh1.copy(), cv2.RETR_EXTERNAL,
+                    cv2.CHAIN_APPROX_SIMPLE)
+                (cnts2, _) = cv2.findContours(
+                    thresh2.copy(), cv2.RETR_EXTERNAL,
+                    cv2.CHAIN_APPROX_SIMPLE)
+
+                # loop over the contours
+                for c1 in cnts1:
+
+                    # if the contour is too small, ignore it
+                    if cv2.contourArea(c1) < args["min_area"]:
+                        continue
+
+                    # compute the bounding box for the contour,
+                    # draw it on the frame, and update the text
+                    (x, y, w, h) = cv2.boundingRect(c1)
+                    cv2.rectangle(
+                        frame_1, (x, y), (x + w, y + h), (0, 255, 0), 2)
+                    text_1 = motion_text
+
+                for c2 in cnts2:
+
+                    # if the contour is too small, ignore it
+                    if cv2.contourArea(c2) < args["min_area"]:
+                        continue
+
+                    # compute the bounding box for the contour,
+                    # draw it on the frame, and update the text
+                    (x, y, w, h) = cv2.boundingRect(c2)
+                    cv2.rectangle(
+                        frame_2, (x, y), (x + w, y + h), (0, 255, 0), 2)
+                    text_2 = motion_text
+                tracer.hop(tag, 'detect')
+
+                # keep the first frame showing motion on the stopped
+                # road for the next light-change decision
+                if change_requested == 0:
+                    if moving_line == 1:
+                        if text_2 == motion_text:
+                            change_tags.motion(tag)
+                    else:
+                        if text_1 == motion_text:
+                            change_tags.motion(tag)
+
+                # draw the motion-detection message on the frame
+                cv2.putText(frame_1, "{}".format(text_1), (60, 20),
+                            cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 0, 255), 2)
+                cv2.putText(frame_2, "{}".format(text_2), (60, 20),
+                            cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 0, 255), 2)
+
+                # Draw the timesatmp on the frame
+                cv2.putText(
+                    frame_1,
+                    datetime.now().strftime("%A %d %B %Y %I:%M:%S%p"),
+                    (10, frame_1.shape[0] - 10),
+                    cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 0, 255), 1)
+                cv2.putText(
+                    frame_2,
+                    datetime.now().strftime("%A %d %B %Y %I:%M:%S%p"),
+                    (10, frame_2.shape[0] - 10),
+                    cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 0, 255), 1)
+
+                # Draw the remaining time before next light-change
+                # and triger the light-change when lap_period_sec is
+                # completed only once per second
+                global lap_to_go
+                global last_second
+                this_second = datetime.now().second
+                if not last_second == this_second:
+                    if lap_to_go <= 0:
+                        light_change(tag=change_tags.dispatch())
+                        lap_to_go = lap_period_sec
+                    if moving_line == 1:
+                        if change_requested == 0:
+                            if text_2 == no_motion_text:
+                                change_tags.no_motion()
+                                if lap_to_go <= lap_period_sec:
+                                    lap_to_go += 1
+                            else:
+                                change_requested = 1
+                                change_tags.request()
+                    else:
+                        if change_requested == 0:
+                            if text_1 == no_motion_text:
+                                change_tags.no_motion()
+                                if lap_to_go <= lap_period_sec:
+                                    lap_to_go += 1
+                            else:
+                                change_requested = 1
+                                change_tags.request()
+                    lap_to_go -= 1
+
+                if moving_line == 1:
+                    if lap_to_go < lap_period_sec:
+                        cv2.putText(
+                            frame_1, "{}".format(lap_to_go), (80, 65),
+                            cv2.FONT_HERSHEY_SIMPLEX, 0.5, yellow_color, 2)
+                else:
+                    if lap_to_go < lap_period_sec:
+                        cv2.putText(
+                            frame_2, "{}".format(lap_to_go), (80, 65),
+                            cv2.FONT_HERSHEY_SIMPLEX, 0.5, yellow_color, 2)
+
+                width_1 = len(frame_1[0, :])
+                heigth1 = len(frame_1[:, 0])
+                total_bytes = width_1 * heigth1 * 6
+
+                total_array = bytearray(total_bytes)
+                byte_array = np.array(total_array)
+                merged_frame = byte_array.reshape(heigth1, (width_1*2), 3)
+                merged_frame[0:heigth1, 0:width_1] = frame_1
+                merged_frame[0:heigth1, width_1:(width_1*2)] = frame_2
+
+                jpg = Image.fromarray(merged_frame)
+                tmp_file = StringIO.StringIO()
+                jpg.save(tmp_file, 'JPEG')
+                if handler is not None:
+                    handler.wfile.write("--jpgboundary")
+                    handler.send_header('Content-type', 'image/jpeg')
+                    handler.send_header(
+                        'Content-length', str(tmp_file.len))
+                    handler.end_headers()
+                    jpg.save(handler.wfile, 'JPEG')
+                time.sleep(0.05)
+
+                last_second = this_second
+            except KeyboardInterrupt:
+                break
+    finally:
+        # let a running light change finish its GPIO writes first
+        if thread is not None:
+            thread.join()
+        tracer.save(args["latency_report"])
+
+
 class cam_handler(BaseHTTPRequestHandler):
     def do_GET(self):
         if self.path.endswith('.mjpg'):
@@ -335,173 +582,7 @@ class cam_handler(BaseHTTPRequestHandler):
                 'multipart/x-mixed-replace; boundary=--jpgboundary')
             self.end_headers()
 
-            # loop over the frames of the video
-            while True:
-                try:
-                    global first_frame_1, first_frame_2
-                    global frame_1, frame_2
-                    # grab the current frame and initialize the
-                    # "Moving object" detection message
-                    (grabbed_1, frame_1) = cameras[0].read()
-                    (grabbed_2, frame_2) = cameras[1].read()
-                    text_1 = no_motion_text
-                    text_2 = no_motion_text
-
-                    # if one of the frames could not be grabbed,
-                    # then we have reached the end of the video
-                    if not (grabbed_1 and grabbed_2):
-                        break
-
-                    # Draw three circles to simulate a semaphore
-                    light_circles()
-
-                    # resize the frame, convert it to grayscale, and blur it
-                    ksize = make_odd(def_ksize)
-                    gray_1 = cv2.cvtColor(frame_1, cv2.COLOR_BGR2GRAY)
-                    gray_2 = cv2.cvtColor(frame_2, cv2.COLOR_BGR2GRAY)
-                    gray_1 = cv2.GaussianBlur(gray_1, (ksize, ksize), 0)
-                    gray_2 = cv2.GaussianBlur(gray_2, (ksize, ksize), 0)
-
-                    # if the first frame is None, initialize it
-                    if first_frame_1 is None:
-                        first_frame_1 = gray_1
-                        first_frame_2 = gray_2
-                        continue
-
-                    # compute the absolute difference between the current
-                    # frame and first frame
-                    Thresh = def_Thresh
-                    frame_delta_1 = cv2.absdiff(first_frame_1, gray_1)
-                    frame_delta_2 = cv2.absdiff(first_frame_2, gray_2)
-                    thresh1 = cv2.threshold(
-                        frame_delta_1, Thresh, 255, cv2.THRESH_BINARY)[1]
-                    thresh2 = cv2.threshold(
-                        frame_delta_2, Thresh, 255, cv2.THRESH_BINARY)[1]
-                    # use current frame for next iteration comparisson
-                    first_frame_1 = gray_1
-                    first_frame_2 = gray_2
-
-                    # dilate the thresholded image to fill in holes,
-                    # then find contours on thresholded image
-                    thresh1 = cv2.dilate(
-                        thresh1, np.ones((dilate_kernel, dilate_kernel)),
-                        iterations=2)
-                    thresh2 = cv2.dilate(
-                        thresh2, np.ones((dilate_kernel, dilate_kernel)),
-                        iterations=2)
-                    (cnts1, _) = cv2.findContours(
-                        thresh1.copy(), cv2.RETR_EXTERNAL,
-                        cv2.CHAIN_APPROX_SIMPLE)
-                    (cnts2, _) = cv2.findContours(
-                        thresh2.copy(), cv2.RETR_EXTERNAL,
-                        cv2.CHAIN_APPROX_SIMPLE)
-
-                    # loop over the contours
-                    for c1 in cnts1:
-
-                        # if the contour is too small, ignore it
-                        if cv2.contourArea(c1) < args["min_area"]:
-                            continue
-
-                        # compute the bounding box for the contour,
-                        # draw it on the frame, and update the text
-                        (x, y, w, h) = cv2.boundingRect(c1)
-                        cv2.rectangle(
-                            frame_1, (x, y), (x + w, y + h), (0, 255, 0), 2)
-                        text_1 = motion_text
-
-                    for c2 in cnts2:
-
-                        # if the contour is too small, ignore it
-                        if cv2.contourArea(c2) < args["min_area"]:
-                            continue
-
-                        # compute the bounding box for the contour,
-                        # draw it on the frame, and update the text
-                        (x, y, w, h) = cv2.boundingRect(c2)
-                        cv2.rectangle(
-                            frame_2, (x, y), (x + w, y + h), (0, 255, 0), 2)
-                        text_2 = motion_text
-
-                    # draw the motion-detection message on the frame
-                    cv2.putText(frame_1, "{}".format(text_1), (60, 20),
-                                cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 0, 255), 2)
-                    cv2.putText(frame_2, "{}".format(text_2), (60, 20),
-                                cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 0, 255), 2)
-
-                    # Draw the timesatmp on the frame
-                    cv2.putText(
-                        frame_1,
-                        datetime.now().strftime("%A %d %B %Y %I:%M:%S%p"),
-                        (10, frame_1.shape[0] - 10),
-                        cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 0, 255), 1)
-                    cv2.putText(
-                        frame_2,
-                        datetime.now().strftime("%A %d %B %Y %I:%M:%S%p"),
-                        (10, frame_2.shape[0] - 10),
-                        cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 0, 255), 1)
-
-                    # Draw the remaining time before next light-change
-                    # and triger the light-change when lap_period_sec is
-                    # completed only once per second
-                    global lap_to_go
-                    global last_second
-                    this_second = datetime.now().second
-                    if not last_second == this_second:
-                        global change_requested
-                        if lap_to_go <= 0:
-                            light_change()
-                            lap_to_go = lap_period_sec
-                        if moving_line == 1:
-                            if change_requested == 0:
-                                if text_2 == no_motion_text:
-                                    if lap_to_go <= lap_period_sec:
-                                        lap_to_go += 1
-                                else:
-                                    change_requested = 1
-                        else:
-                            if change_requested == 0:
-                                if text_1 == no_motion_text:
-                                    if lap_to_go <= lap_period_sec:
-                                        lap_to_go += 1
-                                else:
-                                    change_requested = 1
-                        lap_to_go -= 1
-
-                    if moving_line == 1:
-                        if lap_to_go < lap_period_sec:
-                            cv2.putText(
-                                frame_1, "{}".format(lap_to_go), (80, 65),
-                                cv2.FONT_HERSHEY_SIMPLEX, 0.5, yellow_color, 2)
-                    else:
-                        if lap_to_go < lap_period_sec:
-                            cv2.putText(
-                                frame_2, "{}".format(lap_to_go), (80, 65),
-                                cv2.FONT_HERSHEY_SIMPLEX, 0.5, yellow_color, 2)
-
-                    width_1 = len(frame_1[0, :])
-                    heigth1 = len(frame_1[:, 0])
-                    total_bytes = width_1 * heigth1 * 6
-
-                    total_array = bytearray(total_bytes)
-                    byte_array = np.array(total_array)
-                    merged_frame = byte_array.reshape(heigth1, (width_1*2), 3)
-                    merged_frame[0:heigth1, 0:width_1] = frame_1
-                    merged_frame[0:heigth1, width_1:(width_1*2)] = frame_2
-
-                    jpg = Image.fromarray(merged_frame)
-                    tmp_file = StringIO.StringIO()
-                    jpg.save(tmp_file, 'JPEG')
-                    self.wfile.write("--jpgboundary")
-                    self.send_header('Content-type', 'image/jpeg')
-                    self.send_header('Content-length', str(tmp_file.len))
-                    self.end_headers()
-                    jpg.save(self.wfile, 'JPEG')
-                    time.sleep(0.05)
-
-                    last_second = this_second
-                except KeyboardInterrupt:
-                    break
+            run_frames(self)
             return
         if self.path.endswith('.html'):
             self.send_response(200)
@@ -521,14 +602,39 @@ def main():
         description="Traffic light control using object detection.")
     ap.add_argument("-a", "--min-area",
                     type=int, default=def_minArea, help="minimum area size")
+    ap.add_argument("-r", "--replay", nargs=2, metavar="VIDEO",
+                    help="replay two video files instead of the cameras")
+    ap.add_argument("-l", "--latency-report",
+                    default=def_latency_report,
+                    help="file for the per-hop latency report")
     global args
     args = vars(ap.parse_args())
 
     # ********* System setup **************************
-    gpio_setup()
-
-    sync_time.run()
-    cameras_setup()
+    global tracer, change_tags
+    tracer = latency_trace.latency_tracer(
+        'replay' if args["replay"] else 'live')
+    change_tags = latency_trace.request_tags(tracer)
+    if args["replay"]:
+        # replay runs leave the GPIO pins and the system clock alone
+        for l in range(0, len(lights_tuples)):
+            lights.append(replay_light())
+    else:
+        gpio_setup()
+        sync_time.run()
+
+    cameras_setup(args["replay"])
+    if args["replay"]:
+        for camera in cameras:
+            if not camera.isOpened():
+                print "E: Cannot open replay files, see log for details."
+                return 1
+        # process the whole recording without waiting for a client,
+        # then exit so the latency report can be checked
+        run_frames()
+        cameras[0].release()
+        cameras[1].release()
+        return 0
     global serverIp
     serverIp = set_server_ip.run()
 
@@ -548,6 +654,7 @@ def main():
         cameras[1].release()
         server.socket.close()
         turn_off_all_lights()
+        tracer.save(args["latency_report"])
 
 if __name__ == '__main__':
-    main()
+    sys.exit(main())
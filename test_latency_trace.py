@@ -0,0 +1,214 @@
+#   LightControl. Traffic light control using object detection.
+#   Copyright (C) 2016  Jose Lamego <joselamego@outlook.com>
+#   All rights reserved.
+#   Redistribution and use in source and binary forms, with or without
+#   modification, are permitted provided that the following conditions are met:
+#
+#   1. Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+#
+#   2. Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+#
+#   3. Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from this
+#   software without specific prior written permission.
+#
+#   THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+#   AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+#   IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+#   ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+#   LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+#   CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+#   SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+#   INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+#   CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+#   ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+#   POSSIBILITY OF SUCH DAMAGE.
+#
+
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+import latency_trace
+
+
+class distribution_test(unittest.TestCase):
+
+    def test_empty(self):
+        self.assertEqual(latency_trace.distribution([]), {'count': 0})
+
+    def test_single_value(self):
+        stats = latency_trace.distribution([7.0])
+        self.assertEqual(stats['count'], 1)
+        for stat in latency_trace.report_stats:
+            self.assertEqual(stats[stat], 7.0)
+
+    def test_nearest_rank(self):
+        stats = latency_trace.distribution(range(100, 0, -1))
+        self.assertEqual(stats['count'], 100)
+        self.assertEqual(stats['min'], 1)
+        self.assertEqual(stats['max'], 100)
+        self.assertEqual(stats['p50'], 50)
+        self.assertEqual(stats['p90'], 90)
+        self.assertEqual(stats['p95'], 95)
+        self.assertEqual(stats['p99'], 99)
+
+    def test_nearest_rank_rounds_up(self):
+        stats = latency_trace.distribution([1, 2, 3])
+        self.assertEqual(stats['p50'], 2)
+        self.assertEqual(stats['p90'], 3)
+
+
+class tracer_test(unittest.TestCase):
+
+    def test_hops_and_finish(self):
+        tracer = latency_trace.latency_tracer('replay')
+        tag = tracer.tag()
+        tracer.hop(tag, 'read')
+        tracer.hop(tag, 'detect')
+        tracer.finish(tag)
+        report = tracer.report()
+        self.assertEqual(report['mode'], 'replay')
+        self.assertEqual(
+            sorted(report['hops']), ['detect', 'end_to_end', 'read'])
+        for stats in report['hops'].values():
+            self.assertEqual(stats['count'], 1)
+
+    def test_frame_ids(self):
+        tracer = latency_trace.latency_tracer()
+        self.assertEqual(tracer.tag().frame_id, 1)
+        self.assertEqual(tracer.tag().frame_id, 2)
+
+    def test_untagged(self):
+        tracer = latency_trace.latency_tracer()
+        tracer.hop(None, 'dispatch')
+        tracer.finish(None)
+        self.assertEqual(tracer.report()['hops'], {})
+
+
+class request_tags_test(unittest.TestCase):
+
+    def setUp(self):
+        self.tracer = latency_trace.latency_tracer()
+        self.tags = latency_trace.request_tags(self.tracer)
+
+    def test_first_motion_frame(self):
+        first = self.tracer.tag()
+        self.tags.motion(first)
+        self.tags.motion(self.tracer.tag())
+        self.tags.request()
+        self.assertIs(self.tags.dispatch(), first)
+        hops = self.tracer.report()['hops']
+        self.assertEqual(hops['decision']['count'], 1)
+        self.assertEqual(hops['dispatch']['count'], 1)
+
+    def test_blip_dropped_by_check_without_motion(self):
+        blip = self.tracer.tag()
+        self.tags.motion(blip)
+        self.tags.no_motion()
+        vehicle = self.tracer.tag()
+        self.tags.motion(vehicle)
+        self.tags.request()
+        self.assertIs(self.tags.dispatch(), vehicle)
+
+    def test_untagged_request(self):
+        self.tags.request()
+        self.assertIsNone(self.tags.dispatch())
+        self.assertEqual(self.tracer.report()['hops'], {})
+
+    def test_clear(self):
+        self.tags.motion(self.tracer.tag())
+        self.tags.request()
+        self.tags.motion(self.tracer.tag())
+        self.tags.clear()
+        self.assertIsNone(self.tags.dispatch())
+        self.tags.request()
+        self.assertIsNone(self.tags.dispatch())
+
+
+class check_test(unittest.TestCase):
+
+    report = {'mode': 'live', 'hops': {
+        'detect': latency_trace.distribution([10, 20, 30]),
+        'decision': {'count': 0}}}
+
+    def test_pass(self):
+        self.assertEqual(latency_trace.check(
+            self.report, {'detect:p95': 30, 'detect:min': 10}), [])
+
+    def test_fail(self):
+        failures = latency_trace.check(self.report, {'detect:p95': 29.5})
+        self.assertEqual(len(failures), 1)
+        self.assertTrue(failures[0].startswith('detect:p95 is 30'))
+
+    def test_missing(self):
+        failures = latency_trace.check(
+            self.report, {'decision:p95': 100, 'gpio_yellow:p95': 100})
+        self.assertEqual(failures, [
+            'decision:p95 missing from report',
+            'gpio_yellow:p95 missing from report'])
+
+
+class main_test(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.report = os.path.join(self.directory, 'latency.json')
+        with open(self.report, 'w') as report_file:
+            json.dump({'mode': 'live', 'hops': {
+                'detect': latency_trace.distribution([10, 20, 30])}},
+                report_file)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def exit_status(self, argv):
+        try:
+            return latency_trace.main(argv)
+        except SystemExit as e:
+            return e.code
+
+    def test_within_budget(self):
+        self.assertEqual(
+            self.exit_status([self.report, '-b', 'detect:p95=30']), 0)
+
+    def test_no_budgets(self):
+        self.assertEqual(self.exit_status([self.report]), 0)
+
+    def test_over_budget(self):
+        self.assertEqual(
+            self.exit_status([self.report, '-b', 'detect:p95=25']), 1)
+
+    def test_missing_hop(self):
+        self.assertEqual(
+            self.exit_status([self.report, '-b', 'decision:p95=25']), 1)
+
+    def test_malformed_budget(self):
+        for budget in ('detect=150', 'detect:p95', 'detect:p95=fast',
+                       ':p95=150', 'detect:p75=150', 'detect:count=1',
+                       'detect:p95=nan', 'detect:p95=inf',
+                       'detect:p95=-1'):
+            self.assertEqual(
+                self.exit_status([self.report, '-b', budget]), 2, budget)
+
+    def test_unreadable_report(self):
+        missing = os.path.join(self.directory, 'missing.json')
+        self.assertEqual(
+            self.exit_status([missing, '-b', 'detect:p95=30']), 2)
+        for report in ([], {'hops': {}}, {'mode': 'live'},
+                       {'mode': 'live', 'hops': []},
+                       {'mode': 'live', 'hops': {'detect': 5}},
+                       {'mode': 'live', 'hops': {'detect': {'p95': 'x'}}}):
+            with open(self.report, 'w') as report_file:
+                json.dump(report, report_file)
+            self.assertEqual(self.exit_status(
+                [self.report, '-b', 'detect:p95=30']), 2, report)
+
+
+if __name__ == '__main__':
+    unittest.main()